@@ -21,12 +21,19 @@
 # SOFTWARE.
 #
 
+import errno
 import imaplib
-import email
+import os
+import re
 import sys
-import subprocess
+import queue
+import selectors
+import socket
+import threading
+import time
+import functools
 import concurrent.futures as cf
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import types
 
 # =============================================================================
 # LOGGING FUNCTIONS
@@ -48,36 +55,457 @@ def imap_fatal(mail, result, message):
 # IMAP helpers
 # =============================================================================
 
+_UID_RE = re.compile(rb'UID (\d+)')
+_FLAG_DELETED = br'(\Deleted)'
+_COMMA = b','
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+_STATUS_RE = re.compile(rb'^"?(.*?)"? \(.*\bUNSEEN (\d+)', re.I)
+
+class _StreamingFetch:
+    # imaplib only returns a FETCH response once all of it has been read, so
+    # every message of the request sits in memory at the same time.
+    # fetch_stream() yields (uid, literal) as soon as each message arrives
+    def fetch_stream(self, uid_set, items):
+        tag = self._command('UID', 'FETCH', uid_set, items)
+        while True:
+            line = self._get_line()
+            if line.startswith(tag + b' '):
+                del self.tagged_commands[tag]
+                status = line[len(tag) + 1:].split(None, 1)[0]
+                if status == b'BAD':
+                    raise self.error(line.decode('ascii', 'replace'))
+                return
+            # a response line is split around every literal it contains
+            parts = [line]
+            literals = []
+            m = _LITERAL_RE.search(line)
+            while m:
+                literals.append(self.read(int(m.group(1))))
+                line = self._get_line()
+                parts.append(line)
+                m = _LITERAL_RE.search(line)
+            if b' FETCH ' not in parts[0] or not literals:
+                continue # not for us (EXISTS, EXPUNGE, flag updates...)
+            # the UID can come before or after the message itself
+            m = _UID_RE.search(b' '.join(parts))
+            if m:
+                yield m.group(1), literals[0]
+
+class _IMAP4(_StreamingFetch, imaplib.IMAP4):
+    pass
+
+class _IMAP4_SSL(_StreamingFetch, imaplib.IMAP4_SSL):
+    pass
+
 def imap_login(user, password,
                host, port=imaplib.IMAP4_PORT, ssl=False,
-               verbose=0):
+               verbose=0, fatal=True):
+    # with fatal=False a failure returns None instead of exiting
     try:
-        m = imaplib.IMAP4_SSL(host, port) if ssl else imaplib.IMAP4(host, port)
+        m = _IMAP4_SSL(host, port) if ssl else _IMAP4(host, port)
         
-        verbose_print('Connection to %s established.' % host,
-            verbose)
+        if verbose:
+            verbose_print(f'Connection to {host} established.', verbose)
         
         result, data = m.login(user, password)
         imap_fatal(m, result, 'login failed. Check your username/password')
 
-        verbose_print('Login done.', verbose)
+        if verbose:
+            verbose_print('Login done.', verbose)
+
+        # capabilities may change after login, so ask again only once here
+        result, data = m.capability()
+        caps = data[0].upper().split() if result == 'OK' else []
+        m._has_move = b'MOVE' in caps
+        m._has_uidplus = b'UIDPLUS' in caps
                        
         return m
     except OSError as e:
-        print('connection failed: check your network or the IMAP server name')
-        sys.exit(1)
+        message = 'connection failed: check your network or the IMAP ' \
+            'server name'
     except Exception as e:
-        print("connection failed: %s" % e)
+        message = "connection failed: %s" % e
+    if fatal:
+        print(message)
         sys.exit(1)
+    if verbose:
+        verbose_print(message, verbose)
+    return None
 
 def imap_logout(mail):
-    mail.close()
+    # CLOSE is only allowed with a mailbox selected
+    if mail.state == 'SELECTED':
+        mail.close()
     mail.logout()
 
+def build_uid_set(uids, buf):
+    # write the uids, comma separated, into buf so that the same buffer can
+    # be reused by every FETCH. The returned view must be released (use it
+    # in a with statement) before buf is reused
+    buf.clear()
+    for uid in uids:
+        buf += uid
+        buf += _COMMA
+    return memoryview(buf)[:-1]
+
+def compress_uid_set(uids):
+    # build a compact IMAP sequence set (b'1:5,9,12:14') out of the uids,
+    # to keep the command length bounded on big mailboxes
+    uids = sorted(int(x) for x in uids)
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return _COMMA.join(b'%d' % a if a == b else b'%d:%d' % (a, b)
+                     for a, b in ranges)
+
+# =============================================================================
+# spamd helpers
+# =============================================================================
+
+SPAMD_PORT = 783
+# spamd defaults, used when we cannot find out how it is configured
+SPAMD_MAX_CHILDREN = 5
+# learning is serialized by spamd (bayes db lock) so more workers won't help
+SPAMD_LEARN_WORKERS = 2
+# where distributions keep the options spamd is started with
+SPAMD_OPTIONS_FILES = ['/etc/default/spamd',
+                       '/etc/default/spamassassin',
+                       '/etc/sysconfig/spamassassin']
+
+class SpamdError(Exception):
+    pass
+
+class _SpamdPool:
+    # a bounded number of requests in flight to spamd, shared by all the 
+    # mailboxes being checked. spamd serves a single request per connection
+    # and closes it right after the response, so what is pooled are the 
+    # slots, not the sockets: every request gets a new connection
+    def __init__(self, host, port=SPAMD_PORT, size=5, timeout=60, user=None):
+        self.address = (host, port)
+        self.timeout = timeout
+        # spamd uses the preferences and bayes db of this user
+        self._user = b'User: %s\r\n' % user.encode() if user else b''
+        self._addrinfo = None
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _resolve(self):
+        # looking up spamd's address is the only setup left for a request,
+        # so it's done once instead of once per mail
+        if self._addrinfo is None:
+            self._addrinfo = socket.getaddrinfo(*self.address, 
+                                                type=socket.SOCK_STREAM)
+        return self._addrinfo
+
+    def run(self, command, items, headers=b'', retries=1):
+        # sends command with every (uid, mail) of items and yields 
+        # (uid, headers), or (uid, exception) if the mail could not be 
+        # checked, as the responses arrive. A single selector on this thread 
+        # drives all the connections, and items are only pulled when a slot
+        # is free: mails are not downloaded faster than spamd can check them
+        try:
+            addrinfo = self._resolve()
+        except OSError as e:
+            for uid, mail_raw in items:
+                yield uid, e
+            return
+        sel = selectors.DefaultSelector()
+        items = iter(items)
+        try:
+            while True:
+                # only wait for a slot when there's nothing else to do
+                while items and self._slots.acquire(blocking=not sel.get_map()):
+                    try:
+                        item = next(items, None)
+                    except BaseException:
+                        self._slots.release()
+                        raise
+                    if item is None:
+                        self._slots.release()
+                        items = None
+                        break
+                    uid, mail_raw = item
+                    header = (b'%s SPAMC/1.5\r\n%s%sContent-length: %d\r\n\r\n'
+                              % (command, self._user, headers, len(mail_raw)))
+                    req = _SpamdRequest(addrinfo, uid, header, mail_raw, 
+                                        retries, self.timeout)
+                    if req.start(sel):
+                        self._slots.release()
+                        yield req.result()
+                if not sel.get_map():
+                    return
+                timeout = min(key.data.deadline 
+                              for key in sel.get_map().values())
+                ready = sel.select(max(0, timeout - time.monotonic()))
+                done = [key.data for key, events in ready if key.data.step(sel)]
+                # a request nobody answered for too long is given up on (or
+                # sent again) just like one whose connection was dropped
+                now = time.monotonic()
+                done += [key.data for key in list(sel.get_map().values())
+                         if key.data.deadline <= now 
+                         and key.data.fail(sel, TimeoutError('timed out'))]
+                for req in done:
+                    self._slots.release()
+                    yield req.result()
+        finally:
+            # left early (IMAP errors): no connection or slot must leak
+            for key in list(sel.get_map().values()):
+                key.data.close(sel)
+                self._slots.release()
+            sel.close()
+
+class _SpamdRequest:
+    # a single request on its own non-blocking connection: connecting, 
+    # sending (header and mail go out with gathered writes, the mail is 
+    # never copied into a request buffer), reading until spamd closes the
+    # connection. start() and step() return True once the request is over
+    def __init__(self, addrinfo, uid, header, mail_raw, retries, timeout):
+        self.addrinfo = addrinfo
+        self.uid = uid
+        self.buffers = (header, mail_raw)
+        self.retries = retries
+        self.timeout = timeout
+        self.sock = None
+        self.headers = self.error = None
+
+    def start(self, sel):
+        self.deadline = time.monotonic() + self.timeout
+        self._addrs = iter(self.addrinfo)
+        self._pending = [memoryview(b) for b in self.buffers if b]
+        self._chunks = []
+        return self._connect(sel, None)
+
+    def _connect(self, sel, error):
+        # tries the addresses left, in getaddrinfo order
+        for family, type, proto, name, sockaddr in self._addrs:
+            try:
+                sock = socket.socket(family, type, proto)
+            except OSError as e: # out of descriptors, no IPv6...
+                error = e
+                continue
+            sock.setblocking(False)
+            err = sock.connect_ex(sockaddr)
+            if err in (0, errno.EINPROGRESS):
+                self.sock = sock
+                self._connected = False
+                sel.register(sock, selectors.EVENT_WRITE, self)
+                return False
+            sock.close()
+            error = OSError(err, os.strerror(err))
+        return self.fail(sel, error)
+
+    def step(self, sel):
+        try:
+            if not self._connected:
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    self.close(sel)
+                    return self._connect(sel, OSError(err, os.strerror(err)))
+                self._connected = True
+            if self._pending:
+                _consume(self._pending, self.sock.sendmsg(self._pending))
+                if not self._pending:
+                    sel.modify(self.sock, selectors.EVENT_READ, self)
+                return False
+            chunk = self.sock.recv(65536)
+            if chunk:
+                self._chunks.append(chunk)
+                return False
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            return self.fail(sel, e)
+        self.close(sel)
+        try:
+            self.headers = _parse_spamd_response(b''.join(self._chunks))
+        except SpamdError as e: # spamd errors are not retried
+            self.error = e
+        return True
+
+    def fail(self, sel, error):
+        # a request that fails because of the connection is tried again
+        # on a new one
+        self.close(sel)
+        if self.retries:
+            self.retries -= 1
+            return self.start(sel)
+        self.error = error
+        return True
+
+    def close(self, sel):
+        if self.sock is not None:
+            sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+    def result(self):
+        return self.uid, self.headers if self.error is None else self.error
+
+def _consume(buffers, sent):
+    # drops the first sent bytes from a list of memoryviews
+    while sent:
+        if sent < len(buffers[0]):
+            buffers[0] = buffers[0][sent:]
+            return
+        sent -= len(buffers[0])
+        buffers.pop(0)
+
+def spamd_user(user=None):
+    # like spamc, talk to spamd on behalf of the user running us unless
+    # told otherwise (None: let spamd pick, no user could be found)
+    if user:
+        return user
+    import getpass
+    try:
+        return getpass.getuser()
+    except (KeyError, OSError):
+        return None
+
+def spamd_max_children(paths=SPAMD_OPTIONS_FILES):
+    # look for -m/--max-children in spamd's startup options (None if spamd
+    # is configured somewhere else: systemd unit, container...)
+    regex = re.compile(r'(?:^|[\s"\'])(?:--max-children[=\s]\s*|-m\s*)(\d+)')
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.lstrip().startswith('#'):
+                        continue
+                    m = regex.search(line)
+                    if m:
+                        return int(m.group(1))
+        except OSError:
+            continue
+    return None
+
+def spamd_is_local(host):
+    if host == 'localhost':
+        return True
+    import ipaddress
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def spamd_workers(workers='auto', learn=False, host='localhost'):
+    # there's no point in having more workers than spamd children: the
+    # extra ones would just wait for a free one. Our files only tell 
+    # something about a local spamd, and an explicit number is only capped
+    # by a value we actually found
+    children = spamd_max_children() if spamd_is_local(host) else None
+    if workers == 'auto':
+        workers = min(children or SPAMD_MAX_CHILDREN, 
+                      (os.cpu_count() or 1) * 2)
+    elif children:
+        workers = min(workers, children)
+    if learn:
+        workers = min(workers, SPAMD_LEARN_WORKERS)
+    return max(1, workers)
+
+def _parse_spamd_response(resp):
+    # SPAMD/1.1 <code> <message>, followed by "Name: value" headers
+    lines = resp.partition(b'\r\n\r\n')[0].split(b'\r\n')
+    status = lines[0].split(None, 2)
+    if len(status) < 2 or not status[0].startswith(b'SPAMD/'):
+        raise SpamdError('malformed response from spamd')
+    if status[1] != b'0':
+        raise SpamdError('spamd error: %s' 
+                         % b' '.join(status[1:]).decode('ascii', 'replace'))
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+# =============================================================================
+# Score cache
+# =============================================================================
+
+# how long (in days) spamd verdicts are remembered
+CACHE_TTL = 30
+
+class _ScoreCache:
+    # remembers the result of every check, keyed by account, mailbox,
+    # UIDVALIDITY and uid, so that following runs only score new mail.
+    # Like a cache that cannot be opened, a failing one (locked by another
+    # run, disk full...) never stops the check: mails are just scored again
+    def __init__(self, path, account, ttl=CACHE_TTL, verbose=0):
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.account = account
+        self.verbose = verbose
+        self._error = sqlite3.Error
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS scores ('
+                             'account TEXT, mailbox TEXT, '
+                             'uidvalidity INTEGER, uid INTEGER, '
+                             'score REAL, is_spam INTEGER, ts REAL, '
+                             'PRIMARY KEY (account, mailbox, uidvalidity, uid))')
+            self._db.execute('DELETE FROM scores WHERE ts < ?',
+                             (time.time() - ttl * 86400,))
+
+    def get(self, box, uidvalidity):
+        # {uid: (is_spam, score)}, uids as returned by SEARCH
+        try:
+            with self._lock:
+                rows = self._db.execute('SELECT uid, is_spam, score '
+                                        'FROM scores WHERE account = ? '
+                                        'AND mailbox = ? AND uidvalidity = ?',
+                                        (self.account, box, uidvalidity))
+                return dict((b'%d' % uid, (bool(is_spam), score))
+                            for uid, is_spam, score in rows)
+        except self._error as e:
+            if self.verbose:
+                verbose_print(f'cannot read cache ({e}), not using it for '
+                              f'{box}.', self.verbose)
+            return {}
+
+    def put(self, box, uidvalidity, results):
+        now = time.time()
+        try:
+            with self._lock, self._db:
+                self._db.executemany('INSERT OR REPLACE INTO scores '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     ((self.account, box, uidvalidity, 
+                                       int(uid), score, is_spam, now)
+                                      for uid, is_spam, score in results))
+        except self._error as e:
+            if self.verbose:
+                verbose_print(f'cannot write cache ({e}), {box} results '
+                              f'not saved.', self.verbose)
+
+    def close(self):
+        self._db.close()
+
+def cache_open(account, ttl=CACHE_TTL, verbose=0):
+    d = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = '%s/imap-checker/scores.sqlite3' % d
+    try:
+        return _ScoreCache(path, account, ttl, verbose)
+    except Exception as e:
+        if verbose:
+            verbose_print(f'cannot open cache {path} ({e}), not using it.', 
+                          verbose)
+        return None
+
 # =============================================================================
 # Spam checking functions
 # =============================================================================
 
+# how many mails are requested with a single FETCH while checking
+FETCH_CHUNK = 50
+# how much of every mail is downloaded and given to spamd for scoring
+MAX_SCAN_BYTES = 65536
+# mails bigger than this are never checked (same default as spamc -s)
+MAX_SIZE = 512000
+# IMAP connections used to check mailboxes at the same time (servers limit
+# the logins per user, and the user's own mail client needs some too)
+MAX_CONNECTIONS = 4
+
 def spam_check(mail, 
                action='move',
                boxes=['INBOX'],
@@ -85,132 +513,305 @@ def spam_check(mail,
                only_unread=True, 
                verbose=0,
                workers=5,
-               threshold=4.5):
-    # get uids for every mailbox and do a parallel check using the
-    # spamassassin daemon/client
-    with cf.ThreadPoolExecutor(max_workers=workers) as tpe:
-        results = []
+               threshold=4.5,
+               spamd_host='localhost',
+               spamd_port=SPAMD_PORT,
+               chunk_size=FETCH_CHUNK,
+               connect=None,
+               max_scan_bytes=MAX_SCAN_BYTES,
+               cache=None,
+               max_size=MAX_SIZE,
+               spamd_user=None):
+    # get uids for every mailbox and do a parallel check talking directly
+    # to the spamassassin daemon. If we know how to open new IMAP
+    # connections (connect), up to MAX_CONNECTIONS of them share the
+    # mailboxes, which are then processed at the same time instead of one
+    # after the other
+    # the spamd pool is what really bounds the number of concurrent checks,
+    # whatever the number of mailboxes
+    if only_unread:
+        # with a cheap STATUS, mailboxes without unread mails are never
+        # even selected
+        counts, failed = get_unread_counts(mail, boxes)
+        if verbose:
+            for box in boxes:
+                if box in failed:
+                    verbose_print(f'cannot select mailbox {box}', verbose)
+                elif counts.get(box) == 0:
+                    verbose_print(f'No unread messages in {box}', verbose)
+        boxes = [box for box in boxes 
+                 if box not in failed and counts.get(box, 1) > 0]
+        if not boxes:
+            return
+    spamd = _SpamdPool(spamd_host, spamd_port, workers, user=spamd_user)
+    check = functools.partial(process_mailbox, spamd, 
+                              action=action, 
+                              spam_dir=spam_dir,
+                              only_unread=only_unread, 
+                              verbose=verbose, 
+                              threshold=threshold,
+                              chunk_size=chunk_size,
+                              max_scan_bytes=max_scan_bytes,
+                              cache=cache,
+                              max_size=max_size)
+    if not connect or len(boxes) == 1:
         for box in boxes:
-            uids = get_mailbox_uids(mail, box, only_unread, verbose)
-            # let's optimize this a little if we have no messages
-            if uids:
-                results.append(check_mailbox(tpe, mail, uids, threshold))
-            else:
-                results.append([])
-    for box, res in zip(boxes, results):
-        if not res:
-            verbose_print('%s: 0 spam messages found' % box, verbose)
-            continue
-        result, num = mail.select(mailbox=box)
-        if result != 'OK':
-            verbose_print('cannot select mailbox %s.' % box, verbose, 0)  
-            continue
-        verbose_print('%s: %d spam messages found' % (box, len(res)), verbose)
-        uid_str = b','.join(res)
-        # move all the spam in "Spam" directory
-        if action == 'move':
-            mail.uid('copy', uid_str, spam_dir)
-        mail.uid('store', uid_str, '+FLAGS', '(\Deleted)')
+            check(mail, box)
+        return
+    # every connection takes the next mailbox left as soon as it's done
+    todo = queue.SimpleQueue()
+    for box in boxes:
+        todo.put(box)
+    extra = min(len(boxes), MAX_CONNECTIONS) - 1
+    with cf.ThreadPoolExecutor(max_workers=extra) as boxes_tpe:
+        jobs = [boxes_tpe.submit(process_mailbox_connect, connect, check, todo)
+                for i in range(extra)]
+        # the connection we already have works too, and goes through all 
+        # the mailboxes by itself if no other login succeeds
+        process_mailbox_queue(mail, check, todo)
+        for job in jobs:
+            job.result()
+
+def process_mailbox_connect(connect, check, todo):
+    # a refused login (too many connections...) is not fatal: the mailboxes
+    # are left to the other connections
+    mail = connect(fatal=False)
+    if mail is None:
+        return
+    try:
+        process_mailbox_queue(mail, check, todo)
+    finally:
+        imap_logout(mail)
+
+def process_mailbox_queue(mail, check, todo):
+    while True:
+        try:
+            box = todo.get_nowait()
+        except queue.Empty:
+            return
+        check(mail, box)
+
+def process_mailbox(spamd, mail, box,
+                  action='move',
+                  spam_dir='Spam',
+                  only_unread=True,
+                  verbose=0,
+                  threshold=4.5,
+                  chunk_size=FETCH_CHUNK,
+                  max_scan_bytes=MAX_SCAN_BYTES,
+                  cache=None,
+                  max_size=MAX_SIZE):
+    uids = get_mailbox_uids(mail, box, only_unread, verbose, max_size)
+    # mails scored by a previous run are not downloaded again
+    uidvalidity = get_mailbox_uidvalidity(mail) if cache and uids else None
+    known = cache.get(box, uidvalidity) if uidvalidity else {}
+    if known:
+        results = [(x,) + known[x] for x in uids if x in known]
+        uids = [x for x in uids if x not in known]
+        if verbose >= 2:
+            verbose_print(f'{box}: {len(results)} messages already checked',
+                          verbose, 2)
+    else:
+        results = []
+    # scores are only needed by the cache and to be shown with -vv:
+    # otherwise we just keep the uid of spam (None for the rest)
+    scored = cache is not None or verbose >= 2
+    if scored:
+        spamcheck = functools.partial(do_spamscore, verbose=verbose)
+    else:
+        spamcheck = functools.partial(do_spamcheck, threshold)
+    res = []
+    # let's optimize this a little if we have no messages
+    if uids:
+        checked = check_mailbox(spamd, mail, spamcheck, uids, 
+                                chunk_size, max_scan_bytes, verbose)
+        if not scored:
+            res = [x for x in checked if x is not None]
+        else:
+            # mails we could not check will be tried again next time
+            checked = [x for x in checked if x[1] is not None]
+            if verbose >= 2:
+                for uid, is_spam, score in checked:
+                    verbose_print(f'{box}: mail {uid.decode()} scored {score}',
+                                  verbose, 2)
+            if uidvalidity:
+                cache.put(box, uidvalidity, checked)
+            results += checked
+    res += [x[0] for x in results if x[1] or x[2] >= threshold]
+    if verbose:
+        verbose_print(f'{box}: {len(res)} spam messages found', verbose)
+    if not res:
+        return
+    # box is still selected on this connection after the check
+    uid_str = compress_uid_set(res)
+    # move all the spam in "Spam" directory, with a single round-trip
+    # if the server supports it (RFC 6851)
+    if action == 'move' and mail._has_move:
+        mail.uid('move', uid_str, spam_dir)
+        return
+    if action == 'move':
+        mail.uid('copy', uid_str, spam_dir)
+    mail.uid('store', uid_str, '+FLAGS', _FLAG_DELETED)
+    # UID EXPUNGE (RFC 4315) only removes our messages, without touching
+    # the rest of the mailbox
+    if mail._has_uidplus:
+        mail.uid('expunge', uid_str)
+    else:
         mail.expunge()
 
-def get_mailbox_uids(mail, box, only_unread=True, verbose=0):
+def get_unread_counts(mail, boxes):
+    # STATUS does not touch the selected mailbox, so the requests for all
+    # the boxes are sent back-to-back and answered in a single round-trip.
+    # Returns the counts and the boxes the server refused (no such mailbox,
+    # SELECT would fail too). Boxes missing from both are unknown and must
+    # still be checked
+    counts = {}
+    failed = set()
+    try:
+        tags = [(box, mail._command('STATUS', box, '(UNSEEN)')) 
+                for box in boxes]
+        for box, tag in tags:
+            result, data = mail._command_complete('STATUS', tag)
+            if result != 'OK':
+                failed.add(box)
+    except mail.error:
+        return {}, set()
+    for line in mail.untagged_responses.pop('STATUS', []):
+        m = _STATUS_RE.match(line) if isinstance(line, bytes) else None
+        if m:
+            counts.setdefault(m.group(1).decode('utf-8', 'replace'),
+                              int(m.group(2)))
+    return counts, failed
+
+def get_mailbox_uids(mail, box, only_unread=True, verbose=0, 
+                     max_size=MAX_SIZE):
     result, num = mail.select(mailbox=box)
     if result != 'OK':
-        verbose_print('cannot select mailbox %s' % box, verbose, 1)
+        if verbose:
+            verbose_print(f'cannot select mailbox {box}', verbose)
         return []
-    result, data = mail.uid('search', 
-                            None, 
-                            'UNSEEN' if only_unread else 'ALL')
+    criteria = ['UNSEEN'] if only_unread else []
+    # let the server skip mails too big to be checked, without us ever 
+    # downloading them
+    if max_size:
+        criteria += ['SMALLER', '%d' % max_size]
+    result, data = mail.uid('search', None, *(criteria or ['ALL']))
     if result != 'OK':
-        verbose_print('cannot get info from mailbox %s' % box, verbose, 1)
+        if verbose:
+            verbose_print(f'cannot get info from mailbox {box}', verbose)
         return []      
     # get a list of UIDs
     data = data[0].split()
-    verbose_print('Found %d messages in %s' % (len(data), box), verbose)
+    if verbose:
+        verbose_print(f'Found {len(data)} messages in {box}', verbose)
     return data
 
-def check_mailbox(tpe, mail, uid_list, threshold = 4.5):
-    # RFC822.PEEK enable us to look at mails without marking them as read
-    result, data = mail.uid('fetch', b','.join(uid_list), '(RFC822.PEEK)')
-    # data as a result of multiple UID command is a list of 
-    # <tuple>, <uid string>, <tuple>, <uid_string>, ...
-    # we are only interested in the tuples (more precisely in the second
-    # member of the tuple, which is the email in raw text (header+body)
-    spam_data = tpe.map(do_spamcheck, 
-                        uid_list, 
-                        (x[1] for x in data if isinstance(x, tuple)))
-    return [x[0] for x in spam_data 
-            if x[1] == True or x[2] >= threshold]
-
-def do_spamcheck(uid, mail_raw):
-    p = subprocess.Popen(['spamc', '-c'], 
-                          stdin=subprocess.PIPE, 
-                          stdout=subprocess.PIPE)
+def get_mailbox_uidvalidity(mail):
+    # uids are only valid as long as the UIDVALIDITY returned by SELECT
+    # does not change
+    result, data = mail.response('UIDVALIDITY')
+    try:
+        return int(data[-1])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+def check_mailbox(spamd, mail, spamcheck, uid_list,
+                  chunk_size=FETCH_CHUNK, 
+                  max_scan_bytes=MAX_SCAN_BYTES, verbose=0):
+    # mails are streamed from the server and handed to spamd as soon as 
+    # each one arrives, all on this thread (imaplib is not thread safe, so
+    # the connection never leaves it): spamd.run() overlaps the checks.
+    # BODY.PEEK enable us to look at mails without marking them as read. Only
+    # the first max_scan_bytes are needed: that's what spamd scores anyway
+    # (0 for the whole mail)
+    if max_scan_bytes > 0:
+        fetch_cmd = '(UID BODY.PEEK[]<0.%d>)' % max_scan_bytes
+    else:
+        fetch_cmd = '(UID BODY.PEEK[])'
+    return [spamcheck(uid, resp) for uid, resp in 
+            spamd.run(b'CHECK', fetch_mails(mail, uid_list, fetch_cmd, 
+                                            chunk_size, verbose))]
+
+def fetch_mails(mail, uid_list, fetch_cmd, chunk_size=FETCH_CHUNK, verbose=0):
+    # yields (uid, mail) for every uid, chunk_size uids per FETCH
+    buf = bytearray()
+    for i in range(0, len(uid_list), chunk_size):
+        chunk = uid_list[i:i + chunk_size]
+        fetched = 0
+        with build_uid_set(chunk, buf) as uid_set:
+            for x in mail.fetch_stream(uid_set, fetch_cmd):
+                yield x
+                fetched += 1
+        if fetched != len(chunk) and verbose:
+            verbose_print(f'warning: asked for {len(chunk)} mails, ' 
+                          f'got {fetched}', verbose)
+
+def do_spamcheck(threshold, uid, resp):
+    # returns uid if the mail is spam, None if it's not (or if it could not
+    # be checked: then it must be left alone)
+    try:
+        is_spam, score = _spamd_check(resp)
+    except (OSError, SpamdError, KeyError, ValueError):
+        return None
+    return uid if is_spam or score >= threshold else None
+
+def do_spamscore(uid, resp, verbose=0):
+    # returns (uid, is_spam, score), with is_spam None if the mail could not
+    # be checked at all: it must be left alone, not taken for ham
     try:
-        score = p.communicate(mail_raw)[0]
-    except: # better safe than sorry
-        return (uid, False, 0.0)
-    if score == b'0/0\n': # spamc reports errors this way
-        return (uid, False, 0.0)
-    # binary strings do not support split(), so we need to decode
-    # the output of spamc after stripping it of ('\n)
-    score = float(score.strip().decode().split('/')[0])
-    if p.returncode == 0: # spamc return 0 for non spam...
-        return (uid, False, score)
-
-    # ...and 1 for spam. But who cares?
-    return (uid, True, score)
+        is_spam, score = _spamd_check(resp)
+    except (OSError, SpamdError, KeyError, ValueError) as e:
+        if verbose >= 2:
+            print(f'cannot check mail {uid.decode()}: {e!r}', file=sys.stderr)
+        return (uid, None, 0.0)
+    return (uid, is_spam, score)
+
+def _spamd_check(resp):
+    # resp is what spamd.run() gave back: the headers of the response, or 
+    # the error that prevented the check
+    if isinstance(resp, Exception):
+        raise resp
+    # Spam: <True|False> ; <score> / <threshold>
+    spam, _, score = resp[b'spam'].partition(b';')
+    return spam.strip() == b'True', float(score.split(b'/')[0])
 
 # =============================================================================
 # Spam learning functions
 # =============================================================================
 
-def spam_learn(mail, spam_dir='Spam', workers=5, verbose=0):
-    verbose_print('Starting learning mode on mailbox %s' % spam_dir, verbose)
-    with cf.ThreadPoolExecutor(max_workers=workers) as tpe:
-        result, num = mail.select(mailbox=spam_dir)
-        if result != 'OK':
-            print('Could not select mailbox %s. Aborting.' % spam_dir)
-            return
+def spam_learn(mail, spam_dir='Spam', workers=5, verbose=0,
+               spamd_host='localhost', spamd_port=SPAMD_PORT, 
+               spamd_user=None):
+    if verbose:
+        verbose_print(f'Starting learning mode on mailbox {spam_dir}', verbose)
+    spamd = _SpamdPool(spamd_host, spamd_port, workers, user=spamd_user)
+    result, num = mail.select(mailbox=spam_dir)
+    if result != 'OK':
+        print('Could not select mailbox %s. Aborting.' % spam_dir)
+        return
 
-        result, data = mail.uid('search', None, 'ALL')
-        if result != 'OK':
-            print('Cannot get info from mailbox %s. Aborting.' % spam_dir)
-            return
-    
-        uid_list = data[0].split() 
-        result, data = mail.uid('fetch', b','.join(uid_list), '(RFC822)')
-        if result != 'OK':
-            print('Cannot get fetch mails from mailbox %s. Aborting.' % spam_dir)
-            return       
-
-        # see check_mailbox for info
-        l = tpe.map(do_spamlearn, 
-                    uid_list, 
-                    (x[1] for x in data if isinstance(x, tuple)))
-
-        if verbose > 0:
-            print('Learned %s new messages.' \
-                      % len([x for x in l if x == True]))
-
-def do_spamlearn(uid, mail_raw):
+    result, data = mail.uid('search', None, 'ALL')
+    if result != 'OK':
+        print('Cannot get info from mailbox %s. Aborting.' % spam_dir)
+        return
+
+    uid_list = data[0].split() 
+    # see check_mailbox for info (but here we want the whole mail)
+    l = [do_spamlearn(resp) for uid, resp in 
+         spamd.run(b'TELL', fetch_mails(mail, uid_list, '(UID RFC822)', 
+                                        verbose=verbose),
+                   b'Message-class: spam\r\nSet: local\r\n')]
+
+    if verbose > 0:
+        print('Learned %s new messages.' \
+                  % len([x for x in l if x]))
+
+def do_spamlearn(resp):
     # This needs spamd started with the --allow-tell option
-    p = subprocess.Popen(['spamc', '-L', 'spam'], 
-                         stdin=subprocess.PIPE, 
-                         stdout=subprocess.PIPE)
-    try:
-        out = p.communicate(mail_raw)[0]
-    except:
-        return False
-    code = p.returncode
-    if code == 69 or code == 74: # error connecting
-        return False
-    if code == 5: # learned now
-        return True
-    if code == 6: # already learned
-        return False
-    # catch all not learned
-    return False
+    if isinstance(resp, Exception): # error connecting (even after a retry)
+        return False                # or TELL not allowed
+    # spamd only reports DidSet when the message was not already learned
+    return b'local' in resp.get(b'didset', b'')
 
 # =============================================================================
 # Config parsing
@@ -263,9 +864,6 @@ def config_parse(args):
            'threshold': args.threshold}, **conf)
    
 def config_file(path):
-    import os
-    import configparser
-
     try:
         if path == 'default':
             d = os.environ.get('XDG_CONFIG_HOME')
@@ -273,134 +871,309 @@ def config_file(path):
             path = '%s/imap-checker/config' % d
             
         if not os.path.isfile(path): raise IOError
-        with open(path) as f: pass
+        sections = config_scan(path)
     except IOError as e:
         print('ERROR: config file \'%s\' not found. Aborting.' % path)
         return None
 
-    cp = configparser.ConfigParser()
-    cp.read(path)
+    if sections is None:
+        # something config_scan could not handle, let configparser do it
+        import configparser
+        cp = configparser.ConfigParser()
+        cp.read(path)
+        sections = dict((srv, dict(cp[srv])) for srv in cp.sections())
     d = {}
     
-    if len(cp.sections()) != 1:
+    if len(sections) != 1:
         print('ERROR: config file contains a number of sections that' \
                   'differs from one. Aborting.')
         return None
 
-    srv = cp.sections()[0]
+    srv, opts = sections.popitem()
     d['host'] = srv
 
-    if not set(['user', 'password']) <= set(cp.options(srv)):
+    if not set(['user', 'password']) <= set(opts):
         print('ERROR: option \'user\' and \'password\' are REQUIRED in ' \
                   'config file for IMAP server %s. Please check your ' \
                   'config.' % srv)
         return None
-    d['user'] = cp[srv]['user']
-    d['pass'] = cp[srv]['password']
-
-    if 'domain' in cp[srv]: d['user'] = '%s/%s' % (cp[srv]['domain'], 
-                                                   d['user'])
-    if 'port' in cp[srv]: d['port'] = int(cp[srv]['port'])
-    if 'ssl' in cp[srv]: d['ssl'] = cp[srv].getboolean('ssl')
-    if 'boxes' in cp[srv]: d['boxes'] = ['INBOX'] + cp[srv]['boxes'].split(',')
-    if 'all-mail' in cp[srv]: d['all-mail'] = cp[srv].getboolean('all-mail')
-    if 'spam-dir' in cp[srv]: d['spam-dir'] = cp[srv]['spam-dir']
-    if 'threshold' in cp[srv]: d['threshold'] = cp[srv]['threshold']
+    d['user'] = opts['user']
+    d['pass'] = opts['password']
+
+    if 'domain' in opts: d['user'] = '%s/%s' % (opts['domain'], d['user'])
+    if 'port' in opts: d['port'] = int(opts['port'])
+    if 'ssl' in opts: d['ssl'] = config_bool(opts['ssl'])
+    if 'boxes' in opts: d['boxes'] = ['INBOX'] + opts['boxes'].split(',')
+    if 'all-mail' in opts: d['all-mail'] = config_bool(opts['all-mail'])
+    if 'spam-dir' in opts: d['spam-dir'] = opts['spam-dir']
+    if 'threshold' in opts: d['threshold'] = float(opts['threshold'])
 
     return d
 
+def config_scan(path):
+    # a minimal .ini reader, enough for our config files and much cheaper
+    # than importing configparser. Returns None as soon as it finds
+    # something it does not understand the same way configparser would
+    # (continuation lines, interpolation, duplicates, DEFAULT section...)
+    sections = {}
+    opts = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.lstrip()[0] in '#;':
+                continue
+            if line[0].isspace() or '%' in line:
+                return None
+            line = line.strip()
+            if line[0] == '[' and line[-1] == ']':
+                if line[1:-1] in sections or line[1:-1] == 'DEFAULT':
+                    return None
+                opts = sections[line[1:-1]] = {}
+                continue
+            m = re.match(r'([^:=]+)[:=](.*)$', line)
+            if opts is None or not m or m.group(1).strip().lower() in opts:
+                return None
+            opts[m.group(1).strip().lower()] = m.group(2).strip()
+    return sections
+
+def config_bool(value):
+    # same values accepted by ConfigParser.getboolean()
+    value = value.lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError('not a boolean: %s' % value)
+
 # =============================================================================
 # MAIN
 # =============================================================================
 
 # unfortunately, we need this
 
-def main(argc, argv):
+# command line defaults, shared by argparse and fast_parse_args()
+ARG_DEFAULTS = {
+    'server': '',
+    'port': imaplib.IMAP4_PORT,
+    'ssl': False,
+    'user': '',
+    'password': '',
+    'threshold': 4.5,
+    'learn': False,
+    'method': 'move',
+    'spam_dir': 'Spam',
+    'mailboxes': ['INBOX'],
+    'all_mail': False,
+    'workers': 'auto',
+    'fetch_chunk': FETCH_CHUNK,
+    'max_scan_bytes': MAX_SCAN_BYTES,
+    'max_size': MAX_SIZE,
+    'spamd_host': 'localhost',
+    'spamd_port': SPAMD_PORT,
+    'spamd_user': None,
+    'no_pipeline': False,
+    'no_cache': False,
+    'cache_ttl': CACHE_TTL,
+    'config': None,
+    'verbose': 0,
+}
+
+def workers_arg(value):
+    return value if value == 'auto' else int(value)
+
+def positive_arg(value):
+    value = int(value)
+    if value < 1:
+        import argparse
+        raise argparse.ArgumentTypeError('%d is not a positive number' 
+                                         % value)
+    return value
+
+def parse_args(argv):
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
     p = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
                        description='Detects & deletes spam ' \
                            'from IMAP servers')
     srv = p.add_argument_group('server')
     srv.add_argument('-s', '--server', 
-                     default='',
+                     default=ARG_DEFAULTS['server'],
                      help='the target imap server')
     srv.add_argument('-p', '--port', 
-                     default=imaplib.IMAP4_PORT,
+                     default=ARG_DEFAULTS['port'],
                      help='the imap server port')
     srv.add_argument('--ssl', 
                      action='store_true',
-                     default=False,
+                     default=ARG_DEFAULTS['ssl'],
                      help='use ssl for connecting to the imap server. ' \
                          'Default: false')
     auth = p.add_argument_group('authentication')
     auth.add_argument('-u', '--user',
-                      default='',
+                      default=ARG_DEFAULTS['user'],
                       help='the user for imap auth')
     auth.add_argument('-w', '--password', 
-                      default='',
+                      default=ARG_DEFAULTS['password'],
                       help='the password for imap auth')
     opt = p.add_argument_group('options')
     opt.add_argument('-t', '--threshold',
                      action='store',
-                     default=4.5,
+                     default=ARG_DEFAULTS['threshold'],
                      type=float,
                      help='when detecting spam, set minimum spam score' \
-                         'to this value (default: %(default)')
+                         ' to this value (default: %(default)s)')
     opt.add_argument('-l', '--learn',
                      action='store_true',
-                     default=False,
+                     default=ARG_DEFAULTS['learn'],
                      help='instead of detecting spam, learns new spam' \
                          ' from --spam-dir')
     opt.add_argument('-m', '--method',
-                     default='move',
+                     default=ARG_DEFAULTS['method'],
                      choices=['move', 'delete'],
                      help='what should be done with spam when found. ' \
                          'Default: move')
     opt.add_argument('-d', '--spam-dir',
-                     default='Spam',
+                     default=ARG_DEFAULTS['spam_dir'],
                      help='the imap mailbox where spam is to be moved. ' \
                          'Default: Spam')
     opt.add_argument('-b', '--mailboxes',
                      action='append',
-                     default=['INBOX'],
+                     default=ARG_DEFAULTS['mailboxes'],
                      help='additional mailboxes other than INBOX to analyze' \
                          ' while searching for spam')
     opt.add_argument('--all-mail',
                      action='store_true',
-                     default=False,
+                     default=ARG_DEFAULTS['all_mail'],
                      help='check every mail in the mailbox, not only unread' \
                          ' mails. Default: false')
     opt.add_argument('--workers',
+                     type=workers_arg,
+                     default=ARG_DEFAULTS['workers'],
+                     help='the number of workers to use for spam checking, ' \
+                         'never more than the children of a local spamd ' \
+                         'when they can be found. Default: auto (as many ' \
+                         'as spamd children, %d if unknown)' 
+                         % SPAMD_MAX_CHILDREN)
+    opt.add_argument('--fetch-chunk',
+                     type=positive_arg,
+                     default=ARG_DEFAULTS['fetch_chunk'],
+                     help='how many mails to download at a time while ' \
+                         'checking. Default: %d' % FETCH_CHUNK)
+    opt.add_argument('--max-scan-bytes',
+                     type=int,
+                     default=ARG_DEFAULTS['max_scan_bytes'],
+                     help='how many bytes of every mail are downloaded and ' \
+                         'checked for spam (0 for the whole mail). ' \
+                         'Default: %d' % MAX_SCAN_BYTES)
+    opt.add_argument('--max-size',
+                     type=int,
+                     default=ARG_DEFAULTS['max_size'],
+                     help='do not check mails bigger than this many bytes ' \
+                         '(0 for no limit). Default: %d' % MAX_SIZE)
+    opt.add_argument('--no-pipeline',
+                     action='store_true',
+                     default=ARG_DEFAULTS['no_pipeline'],
+                     help='use a single imap connection, checking mailboxes ' \
+                         'one at a time (for servers that limit ' \
+                         'connections per account). Default: false')
+    opt.add_argument('--no-cache',
+                     action='store_true',
+                     default=ARG_DEFAULTS['no_cache'],
+                     help='check again mails already checked by previous ' \
+                         'runs. Default: false')
+    opt.add_argument('--cache-ttl',
                      type=int,
-                     default=5,
-                     help='the number of workers to use for spam checking. ' \
-                         'Default: 5')
+                     default=ARG_DEFAULTS['cache_ttl'],
+                     help='how many days the result of a check is ' \
+                         'remembered. Default: %d' % CACHE_TTL)
+    spamd = p.add_argument_group('spamd')
+    spamd.add_argument('--spamd-host',
+                       default=ARG_DEFAULTS['spamd_host'],
+                       help='the host where spamd is listening. ' \
+                           'Default: localhost')
+    spamd.add_argument('--spamd-port',
+                       type=int,
+                       default=ARG_DEFAULTS['spamd_port'],
+                       help='the port where spamd is listening. ' \
+                           'Default: %d' % SPAMD_PORT)
+    spamd.add_argument('--spamd-user',
+                       default=ARG_DEFAULTS['spamd_user'],
+                       help='the user whose spamassassin preferences and ' \
+                           'bayes db spamd should use. Default: the ' \
+                           'current user')
     opt.add_argument('-c', '--config',
                      nargs='?',
                      type=str,
-                     default=None,
+                     default=ARG_DEFAULTS['config'],
                      const='default',
                      help='an optional config file to be used instead of ' \
                          'command line configuration. Default: ' \
                          '$XDG_CONFIG_HOME/imap-checker/config')
     opt.add_argument('-v', '--verbose',
                      action='count',
-                     default=0,
+                     default=ARG_DEFAULTS['verbose'],
                      help='verbosity level (use more than once to increase)')
-                     
-    args = p.parse_args(argv)
+
+    return p.parse_args(argv)
+
+def fast_parse_args(argv):
+    # the usual (cron) invocation is just "-c [path] [-v...]": we can skip
+    # building the whole argparse parser for it. None means "use argparse"
+    args = dict(ARG_DEFAULTS, mailboxes=list(ARG_DEFAULTS['mailboxes']))
+    prev = None
+    for arg in argv:
+        if arg in ('-c', '--config'):
+            args['config'] = 'default'
+        elif arg.startswith('--config='):
+            args['config'] = arg[len('--config='):]
+        elif re.fullmatch('-v+', arg):
+            args['verbose'] += len(arg) - 1
+        elif arg == '--verbose':
+            args['verbose'] += 1
+        elif prev in ('-c', '--config') and not arg.startswith('-'):
+            args['config'] = arg
+        else:
+            return None
+        prev = arg
+    if args['config'] is None:
+        return None
+    return types.SimpleNamespace(**args)
+
+def main(argc, argv):
+    args = fast_parse_args(argv) or parse_args(argv)
     conf = config_parse(args)
     if not conf:
         return 1
 
-    mail = imap_login(conf['user'], conf['pass'], 
-                      conf['host'], conf['port'], conf['ssl'],
-                      args.verbose)
+    connect = functools.partial(imap_login, conf['user'], conf['pass'], 
+                                conf['host'], conf['port'], conf['ssl'],
+                                args.verbose)
+    workers = spamd_workers(args.workers, args.learn, args.spamd_host)
+    user = spamd_user(args.spamd_user)
+    if args.verbose >= 2:
+        verbose_print(f'Using {workers} workers.', args.verbose, 2)
+    mail = connect()
     if not args.learn:
+        cache = None
+        if not args.no_cache:
+            cache = cache_open('%s@%s' % (conf['user'], conf['host']), 
+                               args.cache_ttl, args.verbose)
         spam_check(mail, conf['method'],
                    conf['boxes'], conf['spam-dir'], not conf['all-mail'], 
-                   args.verbose, args.workers, conf['threshold'])
+                   args.verbose, workers, conf['threshold'],
+                   spamd_host=args.spamd_host,
+                   spamd_port=args.spamd_port,
+                   chunk_size=args.fetch_chunk,
+                   connect=None if args.no_pipeline else connect,
+                   max_scan_bytes=args.max_scan_bytes,
+                   cache=cache,
+                   max_size=args.max_size,
+                   spamd_user=user)
+        if cache:
+            cache.close()
     else:
-        spam_learn(mail, conf['spam-dir'], args.workers, args.verbose)
+        spam_learn(mail, conf['spam-dir'], workers, args.verbose,
+                   spamd_host=args.spamd_host,
+                   spamd_port=args.spamd_port,
+                   spamd_user=user)
 
     imap_logout(mail)
     return 0